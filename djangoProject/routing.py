@@ -2,5 +2,5 @@ from django.urls import path
 from items.consumers import TaskProgressConsumer
 
 websocket_urlpatterns = [
-    path('ws/progress/', TaskProgressConsumer.as_asgi()),
+    path('ws/progress/<str:task_id>/', TaskProgressConsumer.as_asgi()),
 ]
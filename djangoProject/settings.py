@@ -29,6 +29,9 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
+    # First, so runserver serves the ASGI application. The async views keep their Redis connections
+    # on one event loop, which WSGI would replace on every request
+    'daphne',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -41,16 +44,26 @@ INSTALLED_APPS = [
     'items',
 ]
 
+# The API views only use DRF for request parsing and the Swagger docs. They are not authenticated
+# (the views return plain responses), so skip DRF's per-request authentication and permission checks
+REST_FRAMEWORK = {
+    'DEFAULT_PARSER_CLASSES': [
+        'items.parsers.OrjsonParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_PERMISSION_CLASSES': [],
+    'UNAUTHENTICATED_USER': None,
+}
+
+# The API only takes a user_id, so request bodies are capped far below Django's 2.5 MB default.
+# Also enforced by OrjsonParser, which DRF feeds the raw stream without this check
+DATA_UPLOAD_MAX_MEMORY_SIZE = 1024
+
 # Channels and Redis configuration
 ASGI_APPLICATION = 'djangoProject.asgi.application'
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('redis', 6379)],
-        },
-    },
-}
+# No channel layer: the tasks publish progress on Redis pub/sub, which the websocket consumer subscribes to
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -134,9 +147,11 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
-CELERY_ACCEPT_CONTENT = ['json']
-CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_SERIALIZER = 'json'
+# msgpack keeps broker messages and result-backend progress meta smaller than JSON;
+# json stays accepted so messages queued before the switch can still be consumed
+CELERY_ACCEPT_CONTENT = ['msgpack', 'json']
+CELERY_TASK_SERIALIZER = 'msgpack'
+CELERY_RESULT_SERIALIZER = 'msgpack'
 
 REDIS_HOST = 'redis'
 REDIS_PORT = 6379
@@ -21,7 +21,7 @@ from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 
 from items.views import start_task_idempotency, get_task_status_idempotency, start_task_lock, get_task_status_lock, \
-    process_large_data
+    process_large_data, stream_task_status
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -39,12 +39,14 @@ urlpatterns = [
     re_path(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
     path('admin/', admin.site.urls),
 
-    # API endpoints for processing large data time out (60s)
+    # API endpoints for processing large data (offloaded to Celery, no 60s time out)
     path('process-large-items/', process_large_data, name='process_large_items'),
 
     # API endpoints for idempotency
     path('api/start-task-idempotency/', start_task_idempotency, name='start_task_idempotency'),
     path('api/task-status-idempotency/<str:task_id>/', get_task_status_idempotency, name='get_task_status_idempotency'),
+    # API endpoint for pushed task progress (server-sent events), polling APIs remain as a fallback
+    path('api/task-status-stream/<str:task_id>/', stream_task_status, name='stream_task_status'),
     # API endpoints for lock
     path('api/start-task-lock/', start_task_lock, name='start_task_lock'),
     path('api/task-status-lock/', get_task_status_lock, name='get_task_status_lock'),
@@ -1,25 +1,76 @@
-from channels.generic.websocket import WebsocketConsumer
-import json
-from celery.result import AsyncResult
-
-
-class TaskProgressConsumer(WebsocketConsumer):
-    def connect(self):
-        self.accept()
-
-    def receive(self, text_data):
-        data = json.loads(text_data)
-        task_id = data['task_id']
-        task = AsyncResult(task_id)
-
-        if task.state == 'PROGRESS':
-            self.send(json.dumps({
-                'state': task.state,
-                'current': task.info.get('current'),
-                'total': task.info.get('total'),
-            }))
-        elif task.state == 'SUCCESS':
-            self.send(json.dumps({
-                'state': 'SUCCESS',
-                'message': task.result['message']
-            }))
+import asyncio
+import time
+
+import msgpack
+import orjson
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from .tasks import TERMINAL_STATES, pubsub_redis_client, read_task
+
+# Progress pushed by the tasks is buffered and flushed to the client once per second
+FLUSH_INTERVAL = 1.0
+
+
+def _snapshot(task_id):
+    state, info = read_task(task_id)
+    if state == 'PROGRESS':
+        return {
+            'state': state,
+            'current': info.get('current'),
+            'total': info.get('total'),
+        }
+    elif state == 'SUCCESS':
+        return {
+            'state': 'SUCCESS',
+            'message': info['message']
+        }
+    return {'state': state}
+
+
+class TaskProgressConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        self.task_id = self.scope['url_route']['kwargs']['task_id']
+        self.buffer = []
+
+        # Subscribe to the progress the task publishes before reading its current state,
+        # so no transition published in between is lost
+        self.pubsub = pubsub_redis_client.pubsub()
+        await self.pubsub.subscribe(f'task:{self.task_id}')
+        await self.accept()
+
+        # Read the backend once so a client joining mid-task starts from the current state
+        snapshot = await sync_to_async(_snapshot)(self.task_id)
+        if snapshot['state'] != 'PENDING':
+            await self.buffer_progress(snapshot)
+        self.listener = asyncio.create_task(self.listen())
+        self.flusher = asyncio.create_task(self.flush_periodically())
+
+    async def disconnect(self, close_code):
+        for task in (getattr(self, 'listener', None), getattr(self, 'flusher', None)):
+            if task:
+                task.cancel()
+        if getattr(self, 'pubsub', None):
+            await self.pubsub.aclose()
+
+    async def listen(self):
+        # Buffer the progress published by the task
+        async for message in self.pubsub.listen():
+            if message['type'] == 'message':
+                await self.buffer_progress(orjson.loads(message['data']))
+
+    async def buffer_progress(self, progress_data):
+        self.buffer.append({**progress_data, 'ts': time.time()})
+        if progress_data['state'] in TERMINAL_STATES:
+            await self.flush()
+
+    async def flush(self):
+        if self.buffer:
+            # Binary msgpack frames are smaller and cheaper to encode than JSON text
+            await self.send(bytes_data=msgpack.packb({'batch': self.buffer}))
+            self.buffer = []
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
@@ -1,53 +1,165 @@
 import time
 
+import orjson
 import redis
-from celery import shared_task
+import redis.asyncio
+from celery import Task, shared_task
+from celery.result import AsyncResult
 from django.conf import settings
-from django.core.cache import cache
 
 
-@shared_task(bind=True)
+# Simulated workload: 1M items at 0.1ms each, processed in chunks
+TOTAL_ITEMS = 1_000_000
+ITEM_DURATION = 0.0001
+CHUNKS = 10
+
+
+def process_chunks(task):
+    # One sleep and one progress update per chunk, reporting the items done once the chunk is.
+    # The worker runs on a gevent pool, so each sleep yields the worker slot to other tasks instead of blocking it
+    chunk_size = TOTAL_ITEMS // CHUNKS
+    for chunk in range(CHUNKS):
+        time.sleep(chunk_size * ITEM_DURATION)
+        meta = {'current': (chunk + 1) * chunk_size, 'total': TOTAL_ITEMS}
+        task.update_state(state='PROGRESS', meta=meta)
+        save_task_state(task.request.id, {'state': 'PROGRESS', **meta})
+        send_progress(task.request.id, {'state': 'PROGRESS', **meta})
+    return TOTAL_ITEMS
+
+
+# Configure Redis connection using redis-py, with one explicitly sized pool per process shared by
+# the views and tasks. Never close() the client per request, the pooled connections are meant to be reused
+redis_pool = redis.BlockingConnectionPool(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.REDIS_DB,
+    max_connections=64,
+    socket_keepalive=True,
+    health_check_interval=30,
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+# The same for the async views, which need an asyncio client of their own
+async_redis_pool = redis.asyncio.BlockingConnectionPool(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.REDIS_DB,
+    max_connections=64,
+    socket_keepalive=True,
+    health_check_interval=30,
+)
+async_redis_client = redis.asyncio.Redis(connection_pool=async_redis_pool)
+
+# Each open SSE stream and websocket holds a pub/sub connection, so they get a pool of their own
+# and can never exhaust the one the start and status views need
+pubsub_redis_pool = redis.asyncio.BlockingConnectionPool(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.REDIS_DB,
+    max_connections=256,
+    socket_keepalive=True,
+    health_check_interval=30,
+)
+pubsub_redis_client = redis.asyncio.Redis(connection_pool=pubsub_redis_pool)
+
+# States after which a task publishes nothing more
+TERMINAL_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+
+def send_progress(task_id, progress_data):
+    # Push progress to the websocket and server-sent events clients subscribed to this task through Redis pub/sub.
+    # The worker runs tasks as greenlets on one thread (gevent pool), so this must stay a plain blocking call:
+    # async_to_sync would start an event loop per call, and overlapping calls on the same thread fail
+    redis_client.publish(f'task:{task_id}', orjson.dumps(progress_data))
+
+
+# Running and finished tasks keep their state, progress and result in one Redis hash (kept 10 minutes),
+# so status polls can answer from a single HGETALL instead of going through the result backend
+TASK_STATE_TIMEOUT = 600
+
+
+def save_task_state(task_id, state):
+    key = f'taskstate:{task_id}'
+    mapping = {k: orjson.dumps(v) for k, v in state.items()}
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, TASK_STATE_TIMEOUT)
+        pipe.execute()
+
+
+def read_task(task_id):
+    # Every .state/.info access on an unfinished task queries the result backend again,
+    # so read each once per request (.result is the same value as .info)
+    task = AsyncResult(task_id)
+    return task.state, task.info
+
+
+async def aget_task_state(task_id):
+    data = await async_redis_client.hgetall(f'taskstate:{task_id}')
+    return {k.decode(): orjson.loads(v) for k, v in data.items()} or None
+
+
+class TerminalStateTask(Task):
+    def on_success(self, retval, task_id, args, kwargs):
+        save_task_state(task_id, {'state': 'SUCCESS', 'result': retval})
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        save_task_state(task_id, {'state': 'FAILURE', 'result': str(exc)})
+        send_progress(task_id, {'state': 'FAILURE', 'message': str(exc)})
+
+
+@shared_task(bind=True, base=TerminalStateTask)
+def process_items(self):
+    # Process the items without any duplicate-submission protection
+    total_items = process_chunks(self)
+    send_progress(self.request.id, {'state': 'SUCCESS', 'message': 'Task completed'})
+    return {'message': 'Task completed', 'total_items': total_items}
+
+
+@shared_task(bind=True, base=TerminalStateTask)
 def process_items_idempotency(self, idempotency_key):
     # Process the items
-    total_items = 1_000_000
-    for i in range(total_items):
-        time.sleep(0.0001)
-
-        if i % 100_000 == 0:
-            self.update_state(state='PROGRESS', meta={'current': i, 'total': total_items})
+    total_items = process_chunks(self)
 
-    # Mark task as completed in Redis cache to prevent reprocessing
-    # cache.set(idempotency_key, 'completed', timeout=300)  # Cached for 5m
-    cache.delete(idempotency_key)
+    # The idempotency key is left to expire with the TTL set when it was claimed,
+    # so the same user cannot reissue the task within 5m of starting it
+    send_progress(self.request.id, {'state': 'SUCCESS', 'message': 'Task completed'})
     return {'message': 'Task completed', 'total_items': total_items}
 
 
 # For locked task processing
-# Configure Redis connection using redis-py
-redis_client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
-
 # Lock key timeout in seconds (e.g., 10 minutes)
 LOCK_TIMEOUT = 600
 
 
-@shared_task(bind=True)
-def process_items_lock(self, hashing):
-    lock_key = f"user:{hashing}:lock"
+def make_lock_key(hashing):
+    # Built as bytes from fixed parts, so redis-py sends it as is instead of formatting and encoding a str
+    return b'user:' + hashing.encode() + b':lock'
 
-    try:
-        # Set an expiration on the lock to avoid indefinitely locked tasks
-        redis_client.expire(lock_key, LOCK_TIMEOUT)
-        total_items = 1_000_000
-        for i in range(total_items):
-            time.sleep(0.0001)
 
-            if i % 100_000 == 0:
-                self.update_state(state='PROGRESS', meta={'current': i, 'total': total_items})
+# Delete the lock only if it still holds our token, so a lock that expired and
+# was re-acquired by another request is never released by this task
+release_lock = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+@shared_task(bind=True, base=TerminalStateTask)
+def process_items_lock(self, hashing, token):
+    lock_key = make_lock_key(hashing)
+
+    try:
+        # The lock and its expiration were set atomically when it was acquired
+        total_items = process_chunks(self)
 
         # Task is complete
+        send_progress(self.request.id, {'state': 'SUCCESS', 'message': 'Task completed'})
         return {'message': 'Task completed', 'total_items': total_items}
 
     finally:
         # Release the lock after the task is completed
-        redis_client.delete(lock_key)
+        release_lock(keys=[lock_key], args=[token])
         print(f"Lock released for user")
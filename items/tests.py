@@ -1,40 +1,120 @@
+import asyncio
 import json
-from unittest.mock import patch
+import subprocess
+import sys
+import threading
+from concurrent.futures import wait
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import msgpack
+import orjson
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
 from rest_framework.test import APIClient
 
+from djangoProject.routing import websocket_urlpatterns
+from items.tasks import (
+    CHUNKS, LOCK_TIMEOUT, TASK_STATE_TIMEOUT, TOTAL_ITEMS, aget_task_state, process_chunks, save_task_state
+)
+from items.views import pending_dispatches
+
 
 class TaskAPITestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
 
-    @patch('items.views.process_items_idempotency.apply_async')
-    def test_start_task_idempotency(self, mock_apply_async):
+    @patch('items.views.process_items.apply_async')
+    def test_process_large_data(self, mock_apply_async):
         mock_apply_async.return_value.id = 'test_task_id'
+        url = reverse('process_large_items')
+
+        # Test task is dispatched instead of processed in the request
+        response = self.client.post(url, {}, format='json')
+        self.assertEqual(response.status_code, 202)
+        content = json.loads(response.content)
+        self.assertEqual(content['task_id'], 'test_task_id')
+        mock_apply_async.assert_called_once_with()
+
+    @patch('items.views.process_items_idempotency.apply_async')
+    @patch('items.views.async_redis_client.set', new_callable=AsyncMock)
+    async def test_start_task_idempotency(self, mock_set, mock_apply_async):
         url = reverse('start_task_idempotency')
         data = {'user_id': 1}
 
         # Test successful task start
-        response = self.client.post(url, data, format='json')
+        mock_set.return_value = True
+        response = await self.async_client.post(url, data, content_type='application/json')
         self.assertEqual(response.status_code, 202)
         content = json.loads(response.content)
         self.assertIn('task_id', content)
-        self.assertEqual(content['task_id'], 'test_task_id')
+        # The broker publish runs in the background after the response
+        wait(pending_dispatches)
+
+        # The task is published under the id already returned to the client
+        key = mock_set.call_args.args[0]
+        mock_apply_async.assert_called_once_with(args=[key], task_id=content['task_id'])
 
         # Test idempotency (same request should return 200)
-        response = self.client.post(url, data, format='json')
+        mock_set.return_value = None
+        response = await self.async_client.post(url, data, content_type='application/json')
         self.assertEqual(response.status_code, 200)
         content = json.loads(response.content)
         self.assertEqual(content['message'], 'Your task already processed')
 
         # Test invalid input
-        response = self.client.post(url, {}, format='json')
+        response = await self.async_client.post(url, {}, content_type='application/json')
         self.assertEqual(response.status_code, 400)
 
-    @patch('items.views.AsyncResult')
-    def test_get_task_status_idempotency(self, mock_async_result):
+        # Test invalid user id
+        response = await self.async_client.post(url, {'user_id': 'abc'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for user_id in (-1, 1.9, True, '1.0'):
+            response = await self.async_client.post(url, {'user_id': user_id}, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+        # Test oversized body
+        response = await self.async_client.post(
+            url, {'user_id': 1, 'padding': 'x' * 2048}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 413)
+
+        # Test an oversized body the Content-Length check did not catch is capped by the parser
+        with patch('items.views.body_too_large', return_value=False):
+            response = await self.async_client.post(
+                url, {'user_id': 1, 'padding': 'x' * 2048}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 413)
+
+    @patch('items.views.redis_client.delete')
+    @patch('items.views.process_items_idempotency.apply_async')
+    @patch('items.views.async_redis_client.set', new_callable=AsyncMock, return_value=True)
+    async def test_start_task_dispatch(self, mock_set, mock_apply_async, mock_delete):
+        url = reverse('start_task_idempotency')
+        published = threading.Event()
+        mock_apply_async.side_effect = lambda **kwargs: published.wait(5)
+
+        # The response is sent while a slow broker publish is still running
+        response = await self.async_client.post(url, {'user_id': 1}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(any(not future.done() for future in set(pending_dispatches)))
+        published.set()
+        wait(pending_dispatches)
+        mock_delete.assert_not_called()
+
+        # A failed publish frees the idempotency key so the user can retry
+        mock_apply_async.side_effect = ConnectionError('Broker unavailable')
+        response = await self.async_client.post(url, {'user_id': 1}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        wait(pending_dispatches)
+        mock_delete.assert_called_once_with(mock_set.call_args.args[0])
+
+    @patch('items.views.aget_task_state', new_callable=AsyncMock, return_value=None)
+    @patch('items.tasks.AsyncResult')
+    def test_get_task_status_idempotency(self, mock_async_result, mock_task_state):
         url = reverse('get_task_status_idempotency', args=['test_task_id'])
 
         # Test task in progress
@@ -50,7 +130,7 @@ class TaskAPITestCase(TestCase):
 
         # Test task success
         mock_task.state = 'SUCCESS'
-        mock_task.result = {'message': 'Task completed', 'total_items': 3}
+        mock_task.info = {'message': 'Task completed', 'total_items': 3}
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         content = json.loads(response.content)
@@ -59,43 +139,136 @@ class TaskAPITestCase(TestCase):
 
         # Test task failure
         mock_task.state = 'FAILURE'
-        mock_task.result = Exception('Task failed')
+        mock_task.info = Exception('Task failed')
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         content = json.loads(response.content)
         self.assertEqual(content['state'], 'FAILURE')
 
+    @patch('items.views.aget_task_state', new_callable=AsyncMock, return_value=None)
+    @patch('items.tasks.AsyncResult')
+    def test_get_task_status_idempotency_pending(self, mock_async_result, mock_task_state):
+        cache.clear()
+        url = reverse('get_task_status_idempotency', args=['pending_task_id'])
+
+        # Test unknown/pending task
+        mock_task = mock_async_result.return_value
+        mock_task.state = 'PENDING'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['state'], 'PENDING')
+
+        # Test repeated poll is answered from cache without another backend lookup
+        mock_task.state = 'PROGRESS'
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['state'], 'PENDING')
+        mock_async_result.assert_called_once_with('pending_task_id')
+
+    @patch('items.views.read_task', return_value=('PROGRESS', {'current': 2, 'total': 3}))
+    @patch('items.views.pubsub_redis_client.pubsub')
+    async def test_stream_task_status(self, mock_pubsub, mock_read_task):
+        async def listen():
+            yield {'type': 'subscribe', 'data': 1}
+            yield {'type': 'message', 'data': b'{"state":"PROGRESS","current":3,"total":3}'}
+            yield {'type': 'message', 'data': b'{"state":"SUCCESS","message":"Task completed"}'}
+            yield {'type': 'message', 'data': b'{"state":"PROGRESS","current":0,"total":3}'}
+
+        pubsub = mock_pubsub.return_value.__aenter__.return_value = MagicMock()
+        pubsub.subscribe = AsyncMock()
+        pubsub.listen = listen
+        url = reverse('stream_task_status', args=['test_task_id'])
+
+        # Test current state followed by published transitions, ending at the terminal state
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [
+            json.loads(line[len('data: '):])
+            for line in b''.join([chunk async for chunk in response.streaming_content]).decode().split('\n\n')
+            if line
+        ]
+        self.assertEqual([event['state'] for event in events], ['PROGRESS', 'PROGRESS', 'SUCCESS'])
+        self.assertEqual(events[0]['current'], 2)
+        pubsub.subscribe.assert_awaited_once_with('task:test_task_id')
+
+    @patch('items.views.STREAM_IDLE_TIMEOUT', 0.01)
+    @patch('items.views.read_task')
+    @patch('items.views.pubsub_redis_client.pubsub')
+    async def test_stream_task_status_ends(self, mock_pubsub, mock_read_task):
+        async def listen():
+            yield {'type': 'subscribe', 'data': 1}
+            await asyncio.sleep(10)
+
+        pubsub = mock_pubsub.return_value.__aenter__.return_value = MagicMock()
+        pubsub.subscribe = AsyncMock()
+        pubsub.listen = listen
+        url = reverse('stream_task_status', args=['test_task_id'])
+
+        async def stream():
+            response = await self.async_client.get(url)
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        # Test a revoked task ends the stream right after its state
+        mock_read_task.return_value = ('REVOKED', None)
+        self.assertEqual(await stream(), b'data: {"state":"REVOKED"}\n\n')
+
+        # Test a task that never publishes ends the stream once it is idle
+        mock_read_task.return_value = ('PENDING', None)
+        self.assertEqual(await stream(), b'')
+
+        # Test only GET is allowed
+        response = await self.async_client.post(url)
+        self.assertEqual(response.status_code, 405)
+
     @patch('items.views.process_items_lock.apply_async')
-    @patch('items.views.redis_client.exists')
-    @patch('items.views.redis_client.setnx')
-    def test_start_task_lock(self, mock_setnx, mock_exists, mock_apply_async):
-        mock_apply_async.return_value.id = 'test_task_id'
+    @patch('items.views.async_redis_client.set', new_callable=AsyncMock)
+    async def test_start_task_lock(self, mock_set, mock_apply_async):
         url = reverse('start_task_lock')
         data = {'user_id': 1}
 
         # Test successful task start
-        mock_exists.return_value = False
-        mock_setnx.return_value = True
-        response = self.client.post(url, data, format='json')
+        mock_set.return_value = True
+        response = await self.async_client.post(url, data, content_type='application/json')
         self.assertEqual(response.status_code, 202)
         content = json.loads(response.content)
         self.assertIn('task_id', content)
-        self.assertEqual(content['task_id'], 'test_task_id')
+        # The broker publish runs in the background after the response
+        wait(pending_dispatches)
+
+        # The lock is acquired atomically with a TTL and its token is handed to the task
+        lock_key, token = mock_set.call_args.args
+        self.assertEqual(lock_key, f"user:{content['hashing']}:lock".encode())
+        self.assertEqual(mock_set.call_args.kwargs, {'nx': True, 'ex': LOCK_TIMEOUT})
+        mock_apply_async.assert_called_once_with(args=[content['hashing'], token], task_id=content['task_id'])
 
         # Test locked task (already in progress)
-        mock_exists.return_value = True
-        response = self.client.post(url, data, format='json')
+        mock_set.return_value = None
+        response = await self.async_client.post(url, data, content_type='application/json')
         self.assertEqual(response.status_code, 200)
         content = json.loads(response.content)
         self.assertEqual(content['message'], 'Task is already in progress')
 
         # Test invalid input
-        response = self.client.post(url, {}, format='json')
+        response = await self.async_client.post(url, {}, content_type='application/json')
         self.assertEqual(response.status_code, 400)
 
-    @patch('items.views.AsyncResult')
-    @patch('items.views.redis_client.exists')
-    def test_get_task_status_lock(self, mock_exists, mock_async_result):
+        # Test invalid user id
+        response = await self.async_client.post(url, {'user_id': 'abc'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for user_id in (-1, 1.9, True, '1.0'):
+            response = await self.async_client.post(url, {'user_id': user_id}, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+        # Test oversized body
+        response = await self.async_client.post(
+            url, {'user_id': 1, 'padding': 'x' * 2048}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 413)
+
+    @patch('items.views.aget_task_state', new_callable=AsyncMock, return_value=None)
+    @patch('items.tasks.AsyncResult')
+    @patch('items.views.async_redis_client.exists', new_callable=AsyncMock)
+    def test_get_task_status_lock(self, mock_exists, mock_async_result, mock_task_state):
         url = reverse('get_task_status_lock')
 
         # Test task in progress
@@ -113,7 +286,7 @@ class TaskAPITestCase(TestCase):
         # Test task completed
         mock_exists.return_value = False
         mock_task.state = 'SUCCESS'
-        mock_task.result = {'message': 'Task completed', 'total_items': 3}
+        mock_task.info = {'message': 'Task completed', 'total_items': 3}
         response = self.client.get(url, {'hashing': 'test_hash', 'task_id': 'test_task_id'})
         self.assertEqual(response.status_code, 200)
         content = json.loads(response.content)
@@ -127,3 +300,160 @@ class TaskAPITestCase(TestCase):
         self.assertEqual(response.status_code, 404)
         content = json.loads(response.content)
         self.assertEqual(content['status'], 'not_found')
+
+        # Test the lock is checked once per request
+        self.assertEqual(mock_exists.call_count, 3)
+
+    @patch('items.views.aget_task_state', new_callable=AsyncMock)
+    @patch('items.tasks.AsyncResult')
+    @patch('items.views.async_redis_client.exists', new_callable=AsyncMock)
+    def test_get_task_status_recorded_state(self, mock_exists, mock_async_result, mock_task_state):
+        # Test running task is answered from its recorded state
+        mock_task_state.return_value = {'state': 'PROGRESS', 'current': 2, 'total': 3}
+        response = self.client.get(reverse('get_task_status_idempotency', args=['test_task_id']))
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content['state'], 'PROGRESS')
+        self.assertEqual(content['current'], 2)
+
+        response = self.client.get(reverse('get_task_status_lock'), {'hashing': 'test_hash', 'task_id': 'test_task_id'})
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content['status'], 'in_progress')
+        self.assertEqual(content['details'], {'current': 2, 'total': 3})
+
+        # Test finished task is answered from its recorded state
+        mock_task_state.return_value = {'state': 'SUCCESS', 'result': {'message': 'Task completed', 'total_items': 3}}
+        response = self.client.get(reverse('get_task_status_idempotency', args=['test_task_id']))
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content['state'], 'SUCCESS')
+        self.assertEqual(content['result']['message'], 'Task completed')
+
+        response = self.client.get(reverse('get_task_status_lock'), {'hashing': 'test_hash', 'task_id': 'test_task_id'})
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content['status'], 'completed')
+        self.assertEqual(content['details']['message'], 'Task completed')
+
+        # Test failed task
+        mock_task_state.return_value = {'state': 'FAILURE', 'result': 'Task failed'}
+        response = self.client.get(reverse('get_task_status_lock'), {'hashing': 'test_hash', 'task_id': 'test_task_id'})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(json.loads(response.content)['status'], 'failed')
+
+        # Neither the lock nor the result backend were queried
+        mock_exists.assert_not_called()
+        mock_async_result.assert_not_called()
+
+
+class TaskStateTestCase(TestCase):
+    @patch('items.tasks.async_redis_client.hgetall', new_callable=AsyncMock)
+    @patch('items.tasks.redis_client.pipeline')
+    async def test_task_state_round_trip(self, mock_pipeline, mock_hgetall):
+        pipe = mock_pipeline.return_value.__enter__.return_value
+        state = {'state': 'SUCCESS', 'result': {'message': 'Task completed', 'total_items': 1_000_000}}
+
+        # Test every field is stored orjson-encoded in one hash, with its TTL, in one round trip
+        save_task_state('test_task_id', state)
+        key, = pipe.hset.call_args.args
+        mapping = pipe.hset.call_args.kwargs['mapping']
+        self.assertEqual(key, 'taskstate:test_task_id')
+        self.assertEqual(mapping['state'], b'"SUCCESS"')
+        pipe.expire.assert_called_once_with('taskstate:test_task_id', TASK_STATE_TIMEOUT)
+        pipe.execute.assert_called_once_with()
+
+        # Test the hash reads back, bytes keys included, as the state that was saved
+        mock_hgetall.return_value = {k.encode(): v for k, v in mapping.items()}
+        self.assertEqual(await aget_task_state('test_task_id'), state)
+        mock_hgetall.assert_awaited_with('taskstate:test_task_id')
+
+        # Test a task that recorded nothing
+        mock_hgetall.return_value = {}
+        self.assertIsNone(await aget_task_state('test_task_id'))
+
+
+class TaskProgressConsumerTestCase(TestCase):
+    @patch('items.consumers.FLUSH_INTERVAL', 60)
+    @patch('items.consumers._snapshot', return_value={'state': 'PROGRESS', 'current': 1, 'total': 10})
+    @patch('items.consumers.pubsub_redis_client.pubsub')
+    async def test_task_progress(self, mock_pubsub, mock_snapshot):
+        published = asyncio.Queue()
+
+        async def listen():
+            yield {'type': 'subscribe', 'data': 1}
+            while True:
+                yield {'type': 'message', 'data': orjson.dumps(await published.get())}
+
+        pubsub = mock_pubsub.return_value
+        pubsub.subscribe = AsyncMock()
+        pubsub.aclose = AsyncMock()
+        pubsub.listen = listen
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/progress/test_task_id/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        pubsub.subscribe.assert_awaited_once_with('task:test_task_id')
+
+        # Test published progress is buffered until the next flush
+        await published.put({'state': 'PROGRESS', 'current': 2, 'total': 10})
+        self.assertTrue(await communicator.receive_nothing())
+
+        # Test a terminal state flushes the snapshot and every buffered event in one msgpack frame
+        await published.put({'state': 'SUCCESS', 'message': 'Task completed'})
+        batch = msgpack.unpackb(await communicator.receive_from())['batch']
+        self.assertEqual([event['state'] for event in batch], ['PROGRESS', 'PROGRESS', 'SUCCESS'])
+        self.assertEqual([event.get('current') for event in batch], [1, 2, None])
+        self.assertTrue(all('ts' in event for event in batch))
+        mock_snapshot.assert_called_once_with('test_task_id')
+
+        await communicator.disconnect()
+        pubsub.aclose.assert_awaited_once_with()
+
+
+# Runs send_progress the way the worker does (--pool=gevent): monkey-patched, with two tasks'
+# greenlets on one thread overlapping mid-publish
+SEND_PROGRESS_UNDER_GEVENT = """
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from unittest.mock import patch
+
+import django
+import gevent
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangoProject.settings')
+django.setup()
+
+from items import tasks
+
+with patch.object(tasks.redis_client, 'publish', side_effect=lambda *args: gevent.sleep(0.01)) as publish:
+    greenlets = [gevent.spawn(tasks.send_progress, task_id, {'state': 'PROGRESS'}) for task_id in ('a', 'b')]
+    gevent.joinall(greenlets, raise_error=True)
+    assert publish.call_count == 2
+"""
+
+
+class SendProgressTestCase(TestCase):
+    def test_send_progress_under_gevent(self):
+        result = subprocess.run(
+            [sys.executable, '-c', SEND_PROGRESS_UNDER_GEVENT],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class ProcessChunksTestCase(TestCase):
+    @patch('items.tasks.send_progress')
+    @patch('items.tasks.save_task_state')
+    @patch('items.tasks.time.sleep')
+    def test_process_chunks(self, mock_sleep, mock_save_task_state, mock_send_progress):
+        task = MagicMock()
+
+        # Test each report counts the chunk just processed, ending at the total
+        self.assertEqual(process_chunks(task), TOTAL_ITEMS)
+        currents = [c.kwargs['meta']['current'] for c in task.update_state.call_args_list]
+        self.assertEqual(currents, [TOTAL_ITEMS // CHUNKS * (i + 1) for i in range(CHUNKS)])
+        self.assertEqual(mock_sleep.call_count, CHUNKS)
+        self.assertEqual(mock_send_progress.call_args.args[1]['current'], TOTAL_ITEMS)
+        self.assertEqual(mock_save_task_state.call_args.args[1]['current'], TOTAL_ITEMS)
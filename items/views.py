@@ -1,18 +1,138 @@
+import asyncio
 import hashlib
-import json
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import redis
-from celery.result import AsyncResult
+import orjson
+from adrf.decorators import api_view
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
-from django.http import JsonResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework.decorators import api_view
 
-from .tasks import process_items_idempotency, process_items_lock
+from .parsers import RequestBodyTooLarge
+from .tasks import (
+    process_items, process_items_idempotency, process_items_lock, aget_task_state, read_task, redis_client,
+    async_redis_client, pubsub_redis_client, make_lock_key, release_lock, LOCK_TIMEOUT, TERMINAL_STATES
+)
+
+
+# Request body shared by the start task APIs
+USER_ID_SCHEMA = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    properties={
+        'user_id': openapi.Schema(type=openapi.TYPE_NUMBER, description='User ID')
+    }
+)
+
+
+# Responses of the start task APIs
+START_TASK_RESPONSES = {
+    202: 'Task started',
+    200: 'Task already processed or in progress',
+    400: 'Invalid input',
+    413: 'Request body too large',
+}
+
+# Responses of the lock task status API
+LOCK_STATUS_RESPONSES = {
+    200: openapi.Response(
+        description="Task status: 'in_progress' with the progress details, or 'completed' with the task result",
+        examples={
+            'application/json': {
+                "status": "in_progress",
+                "details": {
+                    "current": 3,
+                    "total": 10
+                }
+            }
+        }
+    ),
+    404: openapi.Response(
+        description="Task not found",
+        examples={
+            'application/json': {
+                "status": "not_found"
+            }
+        }
+    ),
+    500: openapi.Response(
+        description="Task failed",
+        examples={
+            'application/json': {
+                "status": "failed",
+                "details": "Error details"
+            }
+        }
+    ),
+}
+
+
+# The start task APIs only take a user_id, larger bodies are rejected before they are read and parsed.
+# Bodies sent without a Content-Length are capped by OrjsonParser at the same size
+MAX_BODY_SIZE = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+
+
+def body_too_large(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0) > MAX_BODY_SIZE
+    except ValueError:
+        return False
+
+
+def orjson_response(data, status=200):
+    # Serialize with orjson, which returns bytes directly and is much faster than JsonResponse's json.dumps
+    return HttpResponse(orjson.dumps(data), status=status, content_type='application/json')
+
+
+# Broker publishes run on their own threads: not on the request's thread-sensitive executor, where the
+# response would wait behind them, and not on the request's event loop, which a WSGI server tears down
+# (cancelling pending tasks) as soon as the response is returned
+dispatch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='dispatch')
+
+# Publishes still running after their response was sent, referenced here until they finish
+pending_dispatches = set()
+
+
+def dispatch(task, args, release):
+    # Publish the Celery message in the background under a task id chosen up front, so the
+    # response does not wait for the broker and the client can start polling straight away.
+    # If the publish fails nothing will ever run for this request, so release() frees what it claimed
+    task_id = str(uuid.uuid4())
+
+    def publish():
+        try:
+            task.apply_async(args=args, task_id=task_id)
+        except BaseException as e:
+            print(f"Failed to dispatch task {task_id}: {e}")
+            release()
+            raise
+
+    future = dispatch_executor.submit(publish)
+    pending_dispatches.add(future)
+    future.add_done_callback(pending_dispatches.discard)
+    return task_id
+
+
+# Keyed BLAKE2b state for the per-user keys, copying it is cheaper than initialising a new hash per request
+USER_HASH_TEMPLATE = hashlib.blake2b(key=b'idem-v1', digest_size=16)
+
+
+def hash_user(user_id):
+    # The user id is packed as 8 raw bytes instead of being formatted and encoded as a string.
+    # Only integers and integral strings are accepted, int() alone would truncate floats and take
+    # booleans, giving 1.9, 1 and true the same key.
+    # Raises TypeError/ValueError/OverflowError unless it is a non-negative integer
+    if isinstance(user_id, bool) or not isinstance(user_id, (int, str)):
+        raise TypeError(f'Invalid user id: {user_id!r}')
+    h = USER_HASH_TEMPLATE.copy()
+    h.update(int(user_id).to_bytes(8, 'little'))
+    return h.hexdigest()
 
 
 @csrf_exempt
@@ -23,65 +143,61 @@ from .tasks import process_items_idempotency, process_items_lock
         type=openapi.TYPE_OBJECT,
         properties={}
     ),
-    responses={200: 'Task started', 408: 'Request Timeout', 500: 'Invalid input'}
+    responses={202: 'Task started', 500: 'Invalid input'}
 )
 @api_view(['POST'])
 def process_large_data(request):
     try:
-        # Simulate long running task by looping through 1 million records
-        for i in range(1_000_000):
-            # Simulate processing time for each record
-            time.sleep(0.0001)
+        # Offload the 1 million records to Celery so the request returns well within the 60s timeout
+        task = process_items.apply_async()
 
-            # Print a message every 100,000 records
-            if i % 100_000 == 0:
-                print(f"Processed {i} records...")
-        # If the process completes
-        return JsonResponse({"status": "Process completed"}, status=200)
+        # Return task_id in the response, progress is available from the task status APIs
+        return orjson_response({'task_id': task.id, "message": 'Your task is processing'}, status=202)
 
     except Exception as e:
-        return JsonResponse({"error": str(e)}, status=500)
+        return orjson_response({"error": str(e)}, status=500)
 
 
 @csrf_exempt
 @swagger_auto_schema(
     method='post',
     operation_description="Start a new task",
-    request_body=openapi.Schema(
-        type=openapi.TYPE_OBJECT,
-        properties={
-            'user_id': openapi.Schema(type=openapi.TYPE_NUMBER, description='User ID')
-        }
-    ),
-    responses={201: 'Task started', 400: 'Invalid input'}
+    request_body=USER_ID_SCHEMA,
+    responses=START_TASK_RESPONSES
 )
 @api_view(['POST'])
-def start_task_idempotency(request):
+async def start_task_idempotency(request):
     try:
         # Assume this API be validated with a token or other means
-        # Parse items from request body
-        body = json.loads(request.body)
-        # Assume user_id is passed in the request body
-        user_id = body.get('user_id', 0)
+        if body_too_large(request):
+            return orjson_response({'error': 'Request body too large'}, status=413)
+
+        # Assume user_id is passed in the request body (already parsed by DRF)
+        user_id = request.data.get('user_id', 0)
         if not user_id:
-            return JsonResponse({'error': 'No user provided'}, status=400)
+            return orjson_response({'error': 'No user provided'}, status=400)
 
-        # Generate an idempotency key based on user and items
-        idempotency_key = hashlib.sha256(f'{user_id}'.encode()).hexdigest()
-        # Check if the task has already been processed (idempotency check)
-        if cache.get(idempotency_key):
-            return JsonResponse({'message': 'Your task already processed'}, status=200)
-        else:
-            cache.set(idempotency_key, 'processed', timeout=300)  # Cached for 5m
+        # Generate an idempotency key based on user
+        try:
+            idempotency_key = hash_user(user_id)
+        except (TypeError, ValueError, OverflowError):
+            return orjson_response({'error': 'Invalid user'}, status=400)
+        # Claim the key atomically with SET NX EX; no reply means the task has already been processed
+        if not await async_redis_client.set(idempotency_key, 'processed', nx=True, ex=300):  # Cached for 5m
+            return orjson_response({'message': 'Your task already processed'}, status=200)
 
         # Start Celery task
-        task = process_items_idempotency.apply_async(args=[idempotency_key])
+        task_id = dispatch(
+            process_items_idempotency, [idempotency_key], release=lambda: redis_client.delete(idempotency_key)
+        )
 
         # Return task_id in the response
-        return JsonResponse({'task_id': task.id, "message": 'Your task is processing'}, status=202)
+        return orjson_response({'task_id': task_id, "message": 'Your task is processing'}, status=202)
 
+    except RequestBodyTooLarge:
+        return orjson_response({'error': 'Request body too large'}, status=413)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return orjson_response({'error': str(e)}, status=500)
 
 
 @csrf_exempt
@@ -107,93 +223,158 @@ def start_task_idempotency(request):
     }
 )
 @api_view(['GET'])
-def get_task_status_idempotency(request, task_id):
+async def get_task_status_idempotency(request, task_id):
     try:
+        # Unknown and not yet started tasks are both PENDING; answer repeated polls for them
+        # from the local cache instead of hitting the result backend every time
+        pending_key = f'state:{task_id}'
+        if await cache.aget(pending_key) == 'PENDING':
+            return orjson_response({'state': 'PENDING'}, status=200)
+
+        # Started tasks are answered from the state they recorded, without the result backend
+        task_state = await aget_task_state(task_id)
+        if task_state and task_state['state'] == 'PROGRESS':
+            return orjson_response({
+                'state': 'PROGRESS',
+                'current': task_state['current'],
+                'total': task_state['total']
+            }, status=200)
+        elif task_state and task_state['state'] == 'SUCCESS':
+            return orjson_response({'state': 'SUCCESS', 'result': task_state['result']}, status=200)
+        elif task_state:
+            return orjson_response({'state': task_state['state']}, status=200)
+
         # Retrieve the task by ID
-        task = AsyncResult(task_id)
+        state, info = await sync_to_async(read_task)(task_id)
 
         # Handle task progress
-        if task.state == 'PROGRESS':
-            return JsonResponse({
-                'state': task.state,
-                'current': task.info.get('current', 0),
-                'total': task.info.get('total', 1)
+        if state == 'PROGRESS':
+            return orjson_response({
+                'state': state,
+                'current': info.get('current', 0),
+                'total': info.get('total', 1)
             }, status=200)
 
         # Handle task success
-        elif task.state == 'SUCCESS':
-            return JsonResponse({
-                'state': task.state,
-                'result': task.result
+        elif state == 'SUCCESS':
+            return orjson_response({
+                'state': state,
+                'result': info
             }, status=200)
 
         # Handle ignored task (idempotency or other reasons)
-        elif task.state == 'IGNORED':
-            return JsonResponse({
-                'state': task.state,
-                'message': task.info.get('message', 'Task ignored')
+        elif state == 'IGNORED':
+            return orjson_response({
+                'state': state,
+                'message': info.get('message', 'Task ignored')
             }, status=200)
 
         # Handle task failure or other states
         else:
-            return JsonResponse({'state': task.state}, status=200)
+            if state == 'PENDING':
+                await cache.aset(pending_key, state, timeout=1)  # Cached for 1s
+            return orjson_response({'state': state}, status=200)
 
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return orjson_response({'error': str(e)}, status=500)
+
+
+# API for pushing task progress (server-sent events)
+
+# A stream is closed when nothing was published for this long (EventSource clients reconnect and
+# read the current state again), and in any case once it has been open as long as a task may run.
+# Unknown ids and tasks that never publish would otherwise hold their pub/sub connection forever
+STREAM_IDLE_TIMEOUT = 60
+STREAM_TIMEOUT = LOCK_TIMEOUT
+
+
+@require_GET
+async def stream_task_status(request, task_id):
+    async def events():
+        # Subscribe before reading the current state so no transition published in between is lost
+        async with pubsub_redis_client.pubsub() as pubsub:
+            await pubsub.subscribe(f'task:{task_id}')
+
+            state, info = await sync_to_async(read_task)(task_id)
+            if state == 'PROGRESS':
+                yield f"data: {orjson.dumps({'state': state, **info}).decode()}\n\n"
+            elif state != 'PENDING':
+                yield f"data: {orjson.dumps({'state': state}).decode()}\n\n"
+                if state in TERMINAL_STATES:
+                    return
+
+            # Then relay every state transition the task publishes, until it finishes or the stream times out.
+            # Only the reads are bounded, a timeout must never cancel the response while it is writing
+            deadline = time.monotonic() + STREAM_TIMEOUT
+            messages = pubsub.listen()
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        anext(messages), min(STREAM_IDLE_TIMEOUT, deadline - time.monotonic())
+                    )
+                except (TimeoutError, StopAsyncIteration):
+                    return
+                if message['type'] != 'message':
+                    continue
+                yield f"data: {message['data'].decode()}\n\n"
+                if orjson.loads(message['data'])['state'] in TERMINAL_STATES:
+                    return
+
+    return StreamingHttpResponse(events(), content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 # APIs for lock
 
-# Configure Redis connection using redis-py
-redis_client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
-
-
 @csrf_exempt
 @swagger_auto_schema(
     method='post',
     operation_description="Start a new task",
-    request_body=openapi.Schema(
-        type=openapi.TYPE_OBJECT,
-        properties={
-            'user_id': openapi.Schema(type=openapi.TYPE_NUMBER, description='User ID')
-        }
-    ),
-    responses={201: 'Task started', 400: 'Invalid input'}
+    request_body=USER_ID_SCHEMA,
+    responses=START_TASK_RESPONSES
 )
 @api_view(['POST'])
-def start_task_lock(request):
+async def start_task_lock(request):
     try:
         # Assume this API be validated with a token or other means
-        # Parse items from request body
-        body = json.loads(request.body)
-        # Assume user_id is passed in the request body
-        user_id = body.get('user_id', 0)
+        if body_too_large(request):
+            return orjson_response({'error': 'Request body too large'}, status=413)
+
+        # Assume user_id is passed in the request body (already parsed by DRF)
+        user_id = request.data.get('user_id', 0)
         if not user_id:
-            return JsonResponse({'error': 'No user provided'}, status=400)
+            return orjson_response({'error': 'No user provided'}, status=400)
 
         # Check or set lock
-        hashing = hashlib.sha256(f'{user_id}'.encode()).hexdigest()
-        lock_key = f"user:{hashing}:lock"
-
-        if redis_client.exists(lock_key):
+        try:
+            hashing = hash_user(user_id)
+        except (TypeError, ValueError, OverflowError):
+            return orjson_response({'error': 'Invalid user'}, status=400)
+        lock_key = make_lock_key(hashing)
+
+        # Acquire the lock and its TTL in one SET NX EX, so concurrent requests cannot both get it.
+        # The token identifies this acquisition so the task only ever releases its own lock
+        token = uuid.uuid4().hex
+        if not await async_redis_client.set(lock_key, token, nx=True, ex=LOCK_TIMEOUT):
             # If the lock exists, return immediately to avoid duplicate task submission
             print("Task already in progress for user")
-            return JsonResponse({'message': 'Task is already in progress'}, status=200)
-        else:
-            redis_client.setnx(lock_key, 'locked')
+            return orjson_response({'message': 'Task is already in progress'}, status=200)
 
         # Start Celery task
-        task = process_items_lock.apply_async(args=[hashing])
+        task_id = dispatch(
+            process_items_lock, [hashing, token], release=lambda: release_lock(keys=[lock_key], args=[token])
+        )
 
         # Return task_id in the response
-        return JsonResponse({
-            'task_id': task.id,
+        return orjson_response({
+            'task_id': task_id,
             "hashing": hashing,
             "message": 'Your task is processing'
         }, status=202)
 
+    except RequestBodyTooLarge:
+        return orjson_response({'error': 'Request body too large'}, status=413)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return orjson_response({'error': str(e)}, status=500)
 
 
 @csrf_exempt
@@ -201,83 +382,53 @@ def start_task_lock(request):
     method='get',
     manual_parameters=[
         openapi.Parameter(
-            'hashing', openapi.IN_PATH, description="Hashing", type=openapi.TYPE_STRING,
+            'hashing', openapi.IN_QUERY, description="Hashing", type=openapi.TYPE_STRING,
         ),
         openapi.Parameter(
-            'task_id', openapi.IN_PATH, description="Task ID", type=openapi.TYPE_STRING,
+            'task_id', openapi.IN_QUERY, description="Task ID", type=openapi.TYPE_STRING,
         )
     ],
-    responses={
-        200: openapi.Response(
-            description="Task status",
-            examples={
-                'application/json': {
-                    "status": "in_progress",
-                    "details": {
-                        "current": 3,
-                        "total": 10
-                    }
-                }
-            }
-        ),
-        404: openapi.Response(
-            description="Task not found",
-            examples={
-                'application/json': {
-                    "status": "not_found"
-                }
-            }
-        ),
-        500: openapi.Response(
-            description="Task failed",
-            examples={
-                'application/json': {
-                    "status": "failed",
-                    "details": "Error details"
-                }
-            }
-        ),
-        200: openapi.Response(
-            description="Task completed",
-            examples={
-                'application/json': {
-                    "status": "completed",
-                    "details": {
-                        "result": "Task result data"
-                    }
-                }
-            }
-        ),
-    }
+    responses=LOCK_STATUS_RESPONSES
 )
 @api_view(['GET'])
-def get_task_status_lock(request):
+async def get_task_status_lock(request):
     hashing = request.GET.get('hashing', '')
     task_id = request.GET.get('task_id', '')
-    lock_key = f"user:{hashing}:lock"
-
-    task = AsyncResult(task_id)
-    # Check if the task is currently locked (i.e., in progress)
-    if redis_client.exists(lock_key):
+    lock_key = make_lock_key(hashing)
+
+    # Started tasks are answered from the state they recorded with one HGETALL,
+    # without checking the lock or going through the result backend
+    task_state = await aget_task_state(task_id)
+    if task_state and task_state['state'] == 'PROGRESS':
+        details = {'current': task_state['current'], 'total': task_state['total']}
+        return orjson_response({'status': 'in_progress', 'details': details}, status=200)
+    elif task_state and task_state['state'] == 'SUCCESS':
+        return orjson_response({'status': 'completed', 'details': task_state['result'] or {}}, status=200)
+    elif task_state:
+        return orjson_response({'status': 'failed', 'details': task_state['result']}, status=500)
+
+    # Otherwise the task has not started yet, or its recorded state has expired
+
+    state, info = await sync_to_async(read_task)(task_id)
+    # Check if the task is currently locked (i.e., in progress), one round-trip for both checks below
+    locked = await async_redis_client.exists(lock_key)
+    if locked:
 
         # Check the task state (progress, failure, or success)
-        if task.state == 'PROGRESS':
-            task_info = task.info if task.info else {}
-            return JsonResponse({'status': 'in_progress', 'details': task_info}, status=200)
+        if state == 'PROGRESS':
+            return orjson_response({'status': 'in_progress', 'details': info or {}}, status=200)
 
-        elif task.state == 'SUCCESS':
-            task_info = task.result if task.result else {}
-            return JsonResponse({'status': 'completed', 'details': task_info}, status=200)
+        elif state == 'SUCCESS':
+            return orjson_response({'status': 'completed', 'details': info or {}}, status=200)
 
-        elif task.state == 'FAILURE':
-            return JsonResponse({'status': 'failed', 'details': str(task.result)}, status=500)
+        elif state == 'FAILURE':
+            return orjson_response({'status': 'failed', 'details': str(info)}, status=500)
 
         else:
-            return JsonResponse({'status': 'unknown', 'details': task.state}, status=200)
+            return orjson_response({'status': 'unknown', 'details': state}, status=200)
 
     # If no lock exists, return not found status
-    if not redis_client.exists(lock_key) and task.state == 'SUCCESS':
-        task_info = task.result if task.result else {}
-        return JsonResponse({'status': 'completed', 'details': task_info}, status=200)
+    if not locked and state == 'SUCCESS':
+        return orjson_response({'status': 'completed', 'details': info or {}}, status=200)
 
-    return JsonResponse({'status': 'not_found'}, status=404)
+    return orjson_response({'status': 'not_found'}, status=404)